@@ -0,0 +1,59 @@
+"""
+Compiled kernels for the BlindRT60 estimator.
+
+The kernels are built with numba when it is installed; otherwise the estimator falls back to its NumPy implementation.
+"""
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is an optional dependency
+    njit = None
+    prange = range
+
+NUMBA_AVAILABLE = njit is not None
+
+
+def _likelihood_kernel(a, x2, framelen_fac, sigma2_lo, sigma2_hi, eps, out_dl, out_d2l, out_sigma2):
+    """
+    Calculate the derivatives of the log-likelihood in a single pass over each frame.
+
+    Parameters:
+    - a: Parameter 'a' representing the decay rate, shape (batch, 1)
+    - x2: Squared input frames, shape (batch, framelen), float32 or float64; accumulation is always float64
+    - framelen_fac: framelen * (framelen - 1) / 2
+    - sigma2_lo: Lower bound of 'sigma2'
+    - sigma2_hi: Upper bound of 'sigma2'
+    - eps: Regularization added to the denominators
+    - out_dl: Output buffer for the first derivative, shape (batch, 1)
+    - out_d2l: Output buffer for the second derivative, shape (batch, 1)
+    - out_sigma2: Output buffer for the estimated variance, shape (batch, 1)
+    """
+    # framelen is a runtime value on purpose: kernels specialized per framelen (constant trip count) or with the
+    # running product split into interleaved lanes measured no faster, and would need a compilation per framelen.
+    batch, framelen = x2.shape
+    for b in prange(batch):
+        r = a[b, 0] ** -2
+        p = 1.
+        s = 0.
+        s1 = 0.
+        s2 = 0.
+        for k in range(framelen):
+            # p = a ** (-2k) is carried along the frame as a running product
+            w = p * x2[b, k]
+            s += w
+            s1 += k * w
+            s2 += (1 - 2 * k) * k * w
+            p *= r
+
+        sigma2 = min(max(s / framelen, sigma2_lo), sigma2_hi)
+        out_sigma2[b, 0] = sigma2
+        out_dl[b, 0] = 1 / (a[b, 0] + eps) * (1 / (sigma2 + eps) * s1 - framelen_fac)
+        out_d2l[b, 0] = framelen_fac / (a[b, 0] ** 2 + eps) + 1 / (sigma2 + eps) * s2
+
+
+# Only the fast-math flags that allow reordering the reductions: sigma2_hi defaults to inf, so 'ninf' (and 'nnan')
+# would make the kernel undefined for the default sigma2_range
+FASTMATH_FLAGS = {'reassoc', 'contract', 'arcp'}
+
+likelihood_kernel = (njit(parallel=True, fastmath=FASTMATH_FLAGS, cache=True)(_likelihood_kernel)
+                     if NUMBA_AVAILABLE else None)
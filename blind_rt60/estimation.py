@@ -1,13 +1,56 @@
-from typing import Optional, Tuple
+import copy
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from math import gcd
+from typing import TYPE_CHECKING, Optional, Sequence, Tuple
 
-import matplotlib.pyplot as plt
 import numpy as np
 import scipy.signal as sig
-from matplotlib.figure import Figure
+from numpy.lib.stride_tricks import sliding_window_view
+
+from ._kernels import likelihood_kernel
+
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
 
 # Constants
 FRAME_LENGTH = 200e-3  # Frame length in seconds
 EPS = np.finfo('float').eps
+TILE_BYTES = 256 * 1024  # Size of one (frames, framelen) float64 tile of the likelihood computation
+ACTIVE_REFRESH_ITR = 8  # Number of Newton iterations between removals of converged frames from the active set
+
+
+# Estimator used by the worker processes of BlindRT60.estimate_batch
+_worker_estimator = None
+
+
+def _init_worker(estimator):
+    global _worker_estimator
+    _worker_estimator = estimator
+
+
+def _estimate_worker(x: np.ndarray, fs: int) -> float:
+    return _worker_estimator.estimate(x, fs)
+
+
+def _percentile(data: np.ndarray, q: float) -> float:
+    """
+    Linearly interpolated percentile (as np.percentile) using a partial sort.
+
+    Parameters:
+    - data: Input values
+    - q: Percentile between 0 to 100
+
+    Returns:
+    - value: The q-th percentile of data
+    """
+    data = np.ravel(data)
+    rank = q / 100 * (data.size - 1)
+    lower, upper = int(np.floor(rank)), int(np.ceil(rank))
+    partitioned = np.partition(data, (lower, upper))
+    return partitioned[lower] + (rank - lower) * (partitioned[upper] - partitioned[lower])
 
 
 class UpdateMethod:
@@ -60,8 +103,27 @@ class BlindRT60:
         self.n = None
         self.framelen_fac = None
         self.converged = None
+        self._neg2n = None
+        self._n_1m2n = None
+        self._x2 = None
+        self._active = None
+        self._x2_active = None
+        self._buf_a_x_prod = None
 
         self.sanity_check()
+        self.reset_stream()
+
+    def reset_stream(self):
+        """
+        Discard the state of the stream estimated by estimate_stream.
+        """
+        self._stream_fs = None
+        self._stream_sos = None
+        self._stream_zi = None
+        self._stream_phase = 0
+        self._stream_buffer = np.zeros(0)
+        self._stream_taus = []
+        self._stream_converged = []
 
     def init_states(self, batch):
         """
@@ -76,40 +138,80 @@ class BlindRT60:
         self.sigma2 = self.sigma2_init * np.ones((batch, 1))
         self.n = np.expand_dims(np.arange(self.framelen, dtype=float), axis=0)
         self.framelen_fac = self.framelen * (self.framelen - 1) / 2
-        self.converged = False
+        self.converged = np.zeros((batch, 1), dtype=bool)
         self.taus = None
+        self._neg2n = -2. * self.n
+        self._n_1m2n = (1 - 2 * self.n) * self.n
+        self._x2 = None
+        # Frames still updated by the Newton method, and their squared samples
+        self._active = slice(None)
+        self._x2_active = None
+        # Scratch tile of the NumPy likelihood computation, reused by every iteration
+        self._buf_a_x_prod = np.empty((max(1, TILE_BYTES // (self.framelen * 8)), self.framelen))
+
+    def update_active(self):
+        """
+        Remove the converged frames from the set of frames updated by the Newton method.
+        """
+        active = np.flatnonzero(np.bitwise_not(self.converged))
+        if len(active) < self._x2_active.shape[0]:
+            self._active = active
+            self._x2_active = self._x2[active]
 
     def sanity_check(self):
         """
         Check the validity of input parameters.
         """
-        assert 0. <= self.percentile <= 100., 'gamma should be between 0 to 100'
-        assert self.framelen > 0, f'sigma2 should be larger than 0'
-        assert 0. < self.hop <= self.framelen, 'hop must be between 0 to framelen'
-        assert self.a_range[0] <= self.a_init < self.a_range[
-            1], f'a should be between {self.a_range[0]} to {self.a_range[1]}'
-        assert self.sigma2_init > 0., f'sigma2 should be larger than 0'
-
-    def likelihood_derivative(self, a: np.ndarray, x_frames: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        if not 0. <= self.percentile <= 100.:
+            raise ValueError('percentile should be between 0 to 100')
+        if self.framelen <= 0:
+            raise ValueError('framelen should be larger than 0')
+        if not 0. < self.hop <= self.framelen:
+            raise ValueError('hop must be between 0 to framelen')
+        if not self.a_range[0] <= self.a_init < self.a_range[1]:
+            raise ValueError(f'a should be between {self.a_range[0]} to {self.a_range[1]}')
+        if self.sigma2_init <= 0.:
+            raise ValueError('sigma2 should be larger than 0')
+
+    def likelihood_derivative(self, a: np.ndarray, x2: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
         """
         Calculate the first and second derivatives of the log-likelihood function with respect to 'a'.
 
         Parameters:
         - a: Parameter 'a' representing the decay rate
-        - x_frames: Input frames
+        - x2: Squared input frames
 
         Returns:
         - dl_da: First derivative of the log-likelihood with respect to 'a'
         - d2l_da2: Second derivative of the log-likelihood with respect to 'a'
         - sigma2: Estimated variance of the signal
         """
-        a_x_prod = a ** (-2 * self.n) * x_frames ** 2
-        sigma2 = np.clip(np.mean(a_x_prod, axis=1, keepdims=True), a_min=self.sigma2_range[0],
-                         a_max=self.sigma2_range[1])
-        dl_da = 1 / (a + EPS) * (
-                1 / (sigma2 + EPS) * np.sum(self.n * a_x_prod, axis=1, keepdims=True) - self.framelen_fac)
-        d2l_da2 = self.framelen_fac / (a ** 2 + EPS) + 1 / (sigma2 + EPS) * np.sum(
-            (1 - 2 * self.n) * self.n * a_x_prod, axis=1, keepdims=True)
+        # The cost is the number of passes over the (batch, framelen) frames, not the arithmetic per sample,
+        # so prefer changes that fuse or shrink these passes (see docs/performance.md)
+        if likelihood_kernel is not None:
+            dl_da, d2l_da2, sigma2 = np.empty_like(a), np.empty_like(a), np.empty_like(a)
+            likelihood_kernel(a, x2, self.framelen_fac, self.sigma2_range[0], self.sigma2_range[1], EPS,
+                              dl_da, d2l_da2, sigma2)
+            return dl_da, d2l_da2, sigma2
+
+        # The frames are processed in tiles that fit in L2, so a ** (-2n) * x ** 2 stays cache resident while
+        # it is shared by all the reductions below.
+        # The power is evaluated as exp(-2n * log(a)), so only one log per frame is needed.
+        tile = self._buf_a_x_prod.shape[0]
+        sigma2, n_a_x_sum, n_1m2n_a_x_sum = np.empty_like(a), np.empty_like(a), np.empty_like(a)
+        for b0 in range(0, a.shape[0], tile):
+            rows = slice(b0, b0 + tile)
+            a_x_prod = self._buf_a_x_prod[:len(a[rows])]
+            np.multiply(np.log(a[rows]), self._neg2n, out=a_x_prod)
+            np.exp(a_x_prod, out=a_x_prod)
+            a_x_prod *= x2[rows]  # float32 frames are promoted into the float64 tile
+            np.mean(a_x_prod, axis=1, keepdims=True, out=sigma2[rows])
+            np.einsum('bl,l->b', a_x_prod, self.n[0], out=n_a_x_sum[rows, 0])
+            np.einsum('bl,l->b', a_x_prod, self._n_1m2n[0], out=n_1m2n_a_x_sum[rows, 0])
+        sigma2 = np.clip(sigma2, a_min=self.sigma2_range[0], a_max=self.sigma2_range[1])
+
+        dl_da = 1 / (a + EPS) * (1 / (sigma2 + EPS) * n_a_x_sum - self.framelen_fac)
+        d2l_da2 = self.framelen_fac / (a ** 2 + EPS) + 1 / (sigma2 + EPS) * n_1m2n_a_x_sum
         return dl_da, d2l_da2, sigma2
 
     def step(self, x_frames: np.ndarray, method: str) -> np.ndarray:
@@ -121,39 +223,42 @@ class BlindRT60:
         - method: Update method ('newton' or 'bisected')
 
         Returns:
-        - dl_da: The derivative of the likelihood function with respect to 'a'
+        - dl_da: The derivative of the likelihood function with respect to 'a' for the active frames,
+                 evaluated before the Newton update (the frames within max_err are not updated)
         """
+        if self._x2 is None:
+            # The squared frames are stored in float32 to halve the memory traffic of every pass;
+            # a ** (-2n) and all the reductions over them are still evaluated in float64.
+            self._x2 = np.square(x_frames, out=np.empty(x_frames.shape, dtype=np.float32))
+            self._x2_active = self._x2
+
         if method == UpdateMethod.NEWTON:
-            dl_da, d2l_da2, self.sigma2 = self.likelihood_derivative(self.a, x_frames)
-            self.a -= dl_da / (d2l_da2 + EPS)
+            # The derivative at the current 'a' is also the convergence test of the previous update, so a single
+            # evaluation per iteration is needed, and frames that already converged keep their 'a'
+            a = self.a[self._active]
+            dl_da, d2l_da2, self.sigma2[self._active] = self.likelihood_derivative(a, self._x2_active)
+            delta_a = np.where(np.abs(dl_da) <= self.max_err, 0., dl_da / (d2l_da2 + EPS))
+            self.a[self._active] = np.clip(a - delta_a, a_min=self.a_range[0], a_max=self.a_range[1])
         elif method == UpdateMethod.BISECTED:
             middle_a = 0.5 * (self.a_lower + self.a_upper)
-            dl_da_upper, _, _ = self.likelihood_derivative(self.a_upper, x_frames)
-            dl_da_middle, _, _ = self.likelihood_derivative(middle_a, x_frames)
-
-            changed_sign = np.sign(dl_da_upper) != np.sign(dl_da_middle)
-            not_changed_sign = np.bitwise_not(changed_sign)
-            self.a = middle_a
-
-            # No frames changed sign
-            if np.sum(changed_sign) == 0:
-                self.a_upper = middle_a
-            # All frames changed sign
-            elif np.sum(not_changed_sign) == 0:
-                self.a_lower = middle_a
-            # Some frames changed sign
-            else:
-                self.a_lower[changed_sign] = middle_a[changed_sign]
-                self.a_upper[not_changed_sign] = middle_a[not_changed_sign]
+            dl_da_upper, _, _ = self.likelihood_derivative(self.a_upper, self._x2)
+            dl_da_middle, _, sigma2_middle = self.likelihood_derivative(middle_a, self._x2)
+
+            changed_sign = np.signbit(dl_da_upper) ^ np.signbit(dl_da_middle)
+
+            # middle_a lies inside a_range, so the derivative at middle_a is already the one at the updated 'a'
+            self.a = np.clip(middle_a, a_min=self.a_range[0], a_max=self.a_range[1])
+            dl_da, self.sigma2 = dl_da_middle, sigma2_middle
+
+            # Frames that changed sign keep the root in [middle_a, a_upper], the rest in [a_lower, middle_a]
+            np.copyto(self.a_lower, middle_a, where=changed_sign)
+            np.copyto(self.a_upper, middle_a, where=np.bitwise_not(changed_sign))
         else:
             raise ValueError(f'method {method} should be {UpdateMethod.NEWTON} or {UpdateMethod.BISECTED}')
 
-        self.a = np.clip(self.a, a_min=self.a_range[0], a_max=self.a_range[1])
-        dl_da, d2l_da2, self.sigma2 = self.likelihood_derivative(self.a, x_frames)
-
         return dl_da
 
-    def visualize(self, x: np.ndarray, fs: int, ylim: Tuple = (0, 1)) -> Figure:
+    def visualize(self, x: np.ndarray, fs: int, ylim: Tuple = (0, 1)) -> "Figure":
         """
         Visualize the input signal, estimated Room Impulse Response (RT60), and its histogram.
 
@@ -165,10 +270,13 @@ class BlindRT60:
         Returns:
         - fig: Matplotlib figure object
         """
-        assert self.taus is not None
-        assert self.rt60 is not None
-        assert self.tau is not None
-        assert np.ndim(x) == 1
+        # matplotlib is imported here so that estimation does not pay for its import time
+        import matplotlib.pyplot as plt
+
+        if self.taus is None or self.rt60 is None or self.tau is None:
+            raise ValueError('estimate should be called before visualize')
+        if np.ndim(x) != 1:
+            raise ValueError(f'x should be a 1-D signal, got {np.ndim(x)} dimensions')
         x_duration = len(x) / fs
 
         fig, axs = plt.subplots(nrows=1, ncols=2, width_ratios=(3, 1), sharey=True)
@@ -203,34 +311,66 @@ class BlindRT60:
         fig.tight_layout()
         return fig
 
-    def estimate(self, x: np.ndarray, fs: int) -> float:
+    def frames(self, x: np.ndarray, fs: int) -> np.ndarray:
         """
-        Estimate the reverberation time (RT60) from the input signal.
+        Resample the input signal to the estimator sample rate and split it into frames.
 
         Parameters:
         - x: Input signal
         - fs: Sampling frequency of the input signal
 
         Returns:
-        - rt60: Estimated RT60
+        - x_frames: Input frames, a zero-copy view of the resampled signal
         """
-        self.sanity_check()
-        assert np.ndim(x) == 1
+        if fs > self.fs and fs % self.fs == 0:
+            x = sig.decimate(x, int(fs // self.fs))
+        elif fs != self.fs:
+            g = gcd(int(self.fs), int(fs))
+            x = sig.resample_poly(x, int(self.fs) // g, int(fs) // g)
+        # Zero-copy view of the frames; the only copy is made when the frames are squared in step()
+        return sliding_window_view(x, self.framelen)[::self.hop]
+
+    def fit(self, x_frames: np.ndarray) -> int:
+        """
+        Estimate the decay rate 'a' of each frame.
+
+        Parameters:
+        - x_frames: Input frames
 
-        x = sig.decimate(x, int(fs // self.fs)) if fs > self.fs else sig.resample(x, int(len(x) * self.fs / fs))
-        x_frames = np.array([x[i:i + self.framelen] for i in range(0, len(x) - self.framelen + 1, self.hop)])
+        Returns:
+        - itr: Number of iterations
+        """
         self.init_states(x_frames.shape[0])
 
         itr = 0
-        while itr < self.bisected_itr or (itr < self.max_itr and np.any(np.bitwise_not(self.converged))):
+        while itr < self.bisected_itr or (itr < self.max_itr and not self.converged.all()):
             method = UpdateMethod.BISECTED if itr < self.bisected_itr else UpdateMethod.NEWTON
             dl_da = self.step(x_frames, method=method)
-            self.converged = np.abs(dl_da) <= self.max_err
+            self.converged[self._active] = np.abs(dl_da) <= self.max_err
             itr += 1
+            if itr >= self.bisected_itr and (itr - self.bisected_itr) % ACTIVE_REFRESH_ITR == 0:
+                self.update_active()
 
         self.taus = -1 / np.log(self.a) / self.fs
         self.taus[np.bitwise_not(self.converged)] = np.nan
-        self.tau = np.percentile(self.taus[self.converged], q=self.percentile)
+        return itr
+
+    def estimate(self, x: np.ndarray, fs: int) -> float:
+        """
+        Estimate the reverberation time (RT60) from the input signal.
+
+        Parameters:
+        - x: Input signal
+        - fs: Sampling frequency of the input signal
+
+        Returns:
+        - rt60: Estimated RT60
+        """
+        if np.ndim(x) != 1:
+            raise ValueError(f'x should be a 1-D signal, got {np.ndim(x)} dimensions')
+
+        itr = self.fit(self.frames(x, fs))
+        self.tau = _percentile(self.taus[self.converged], q=self.percentile)
         self.rt60 = -3 * self.tau / np.log10(np.e ** -1)
 
         if self.verbose:
@@ -238,6 +378,140 @@ class BlindRT60:
 
         return self.rt60
 
+    def estimate_multichannel(self, x: np.ndarray, fs: int) -> np.ndarray:
+        """
+        Estimate the reverberation time (RT60) of each channel of the input signal.
+        The frames of all the channels are estimated together in a single iteration loop.
+        After the estimation, taus holds the frames of all the channels, and tau and rt60 hold one value per channel.
+
+        Parameters:
+        - x: Input signal, shape (channels, samples)
+        - fs: Sampling frequency of the input signal
+
+        Returns:
+        - rt60: Estimated RT60 of each channel
+        """
+        if np.ndim(x) != 2:
+            raise ValueError(f'x should be a (channels, samples) signal, got {np.ndim(x)} dimensions')
+
+        channel_frames = [self.frames(channel, fs) for channel in x]
+        itr = self.fit(np.concatenate(channel_frames))
+
+        boundaries = np.cumsum([len(frames) for frames in channel_frames])[:-1]
+        self.tau = np.array([_percentile(taus[converged], q=self.percentile) for taus, converged in
+                             zip(np.split(self.taus, boundaries), np.split(self.converged, boundaries))])
+        self.rt60 = -3 * self.tau / np.log10(np.e ** -1)
+
+        if self.verbose:
+            print(f'Iteration {itr} / {self.max_itr}; rt60 {np.round(self.rt60, 2)} sec; tau {np.round(self.tau, 2)} sec')
+
+        return self.rt60
+
+    def _stream_decimate(self, x: np.ndarray) -> np.ndarray:
+        """
+        Decimate a chunk of the stream, continuing the filter state and the decimation phase of the previous chunk.
+
+        Parameters:
+        - x: Chunk of the input signal
+
+        Returns:
+        - x: Decimated chunk
+        """
+        if self._stream_sos is None or not len(x):
+            return x
+
+        q = int(self._stream_fs // self.fs)
+        if self._stream_zi is None:
+            self._stream_zi = sig.sosfilt_zi(self._stream_sos) * x[0]
+        y, self._stream_zi = sig.sosfilt(self._stream_sos, x, zi=self._stream_zi)
+        x = y[self._stream_phase::q]
+        self._stream_phase = (self._stream_phase - len(y)) % q
+        return x
+
+    def estimate_stream(self, x: np.ndarray, fs: int, final: bool = False) -> Optional[float]:
+        """
+        Estimate the reverberation time (RT60) from an input signal received in consecutive chunks.
+        The decay rate of each frame is estimated as soon as the frame is complete, and the RT60 is computed from all
+        the frames of the stream once the last chunk is given.
+        The decimation filter keeps its state between the chunks; unlike estimate, which filters the whole signal
+        forward and backward, it is causal, so the two estimates can differ slightly when fs > self.fs.
+
+        Parameters:
+        - x: Chunk of the input signal
+        - fs: Sampling frequency of the input signal, an integer multiple of the estimator sample rate
+        - final: Whether x is the last chunk of the stream
+
+        Returns:
+        - rt60: Estimated RT60 when final is True, otherwise None
+        """
+        if np.ndim(x) != 1:
+            raise ValueError(f'x should be a 1-D signal, got {np.ndim(x)} dimensions')
+        if self._stream_fs is None:
+            if fs < self.fs or fs % self.fs != 0:
+                raise ValueError(f'fs should be an integer multiple of {self.fs} for stream estimation')
+            self._stream_fs = fs
+            if fs > self.fs:
+                # Same anti-aliasing filter as sig.decimate
+                self._stream_sos = sig.cheby1(8, 0.05, 0.8 / int(fs // self.fs), output='sos')
+        elif fs != self._stream_fs:
+            raise ValueError(f'fs should stay {self._stream_fs} during the stream, got {fs}')
+
+        x = self._stream_decimate(np.asarray(x, dtype=float))
+
+        # Estimate the completed frames and keep the samples of the next, incomplete ones (less than framelen)
+        buffer = np.concatenate((self._stream_buffer, x))
+        n_frames = (len(buffer) - self.framelen) // self.hop + 1 if len(buffer) >= self.framelen else 0
+        if n_frames:
+            self.fit(sliding_window_view(buffer, self.framelen)[::self.hop][:n_frames])
+            self._stream_taus.append(self.taus)
+            self._stream_converged.append(self.converged)
+        self._stream_buffer = buffer[n_frames * self.hop:]
+
+        if not final:
+            return None
+
+        if not self._stream_taus:
+            self.reset_stream()
+            raise ValueError('the stream is shorter than a single frame')
+        self.taus = np.concatenate(self._stream_taus)
+        self.converged = np.concatenate(self._stream_converged)
+        self.reset_stream()
+
+        self.tau = _percentile(self.taus[self.converged], q=self.percentile)
+        self.rt60 = -3 * self.tau / np.log10(np.e ** -1)
+
+        if self.verbose:
+            print(f'Frames {len(self.taus)}; rt60 {self.rt60:.2f} sec; tau {self.tau:.2f} sec')
+
+        return self.rt60
+
+    def estimate_batch(self, xs: Sequence[np.ndarray], fs: int, n_workers: Optional[int] = None) -> np.ndarray:
+        """
+        Estimate the reverberation time (RT60) of several input signals, e.g. microphone channels, in parallel.
+        When numba is installed the worker processes are spawned, and spawned workers import the caller's main module:
+        scripts calling estimate_batch at top level must protect it with `if __name__ == '__main__':`.
+
+        Parameters:
+        - xs: Input signals
+        - fs: Sampling frequency of the input signals
+        - n_workers: Number of worker processes (default is the number of CPUs minus one)
+
+        Returns:
+        - rt60s: Estimated RT60 of each input signal
+        """
+        # Each worker process receives a copy of the estimator without the states of previous estimations
+        estimator = copy.copy(self)
+        estimator.init_states(0)
+        n_workers = n_workers or max(1, (os.cpu_count() or 1) - 1)
+
+        # With numba the workers are spawned rather than forked, since forking a process that already runs the numba
+        # thread pool can deadlock; otherwise the platform default is kept
+        mp_context = multiprocessing.get_context('spawn') if likelihood_kernel is not None else None
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context,
+                                 initializer=_init_worker, initargs=(estimator,)) as executor:
+            rt60s = list(executor.map(_estimate_worker, xs, itertools.repeat(fs)))
+        return np.array(rt60s)
+
     def __call__(self, *args, **kwargs):
         """
         Call the estimate method when the object is called.
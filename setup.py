@@ -21,13 +21,14 @@ setuptools.setup(
         'License :: OSI Approved :: MIT License',
         "Operating System :: OS Independent",
     ],
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     install_requires=[
         "scipy",
-        "numpy",
+        "numpy>=1.20",
         "matplotlib"
     ],
     extras_require={
-        "dev": ["pyroomacoustics", "parameterized"],
+        "dev": ["pyroomacoustics", "parameterized", "numba"],
+        "numba": ["numba"],
     },
 )
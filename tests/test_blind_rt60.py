@@ -1,6 +1,7 @@
 import os
 import unittest
 import warnings
+from unittest import mock
 
 import numpy as np
 import pyroomacoustics as pra
@@ -8,6 +9,7 @@ from parameterized import parameterized, param
 from scipy.io import wavfile
 
 from blind_rt60 import BlindRT60
+from blind_rt60._kernels import NUMBA_AVAILABLE
 
 
 def decaying_chirp(fs, duration: float = 5.0, frequency_start: float = 250.0, frequency_end: float = 1000.0,
@@ -44,6 +46,7 @@ class TestRT60(unittest.TestCase):
     @parameterized.expand([
         param(fs_sig=16000, fs_estimator=8000),
         param(fs_sig=4000, fs_estimator=8000),
+        param(fs_sig=44100, fs_estimator=8000),
     ])
     def test_decimate(self, fs_sig: int = 16000, fs_estimator: int = 8000):
         """
@@ -78,6 +81,113 @@ class TestRT60(unittest.TestCase):
         blind_rt60 = BlindRT60(fs=fs_estimator)
         self.assertGreater(blind_rt60(x1, fs_sig), blind_rt60(x2, fs_sig))
 
+    @parameterized.expand([
+        param(percentile=101.),
+        param(hop=0.3),
+        param(a_init=0.9),
+        param(sigma2_init=0.),
+    ])
+    def test_invalid_parameters(self, **kwargs):
+        """
+        Test that invalid parameters are rejected when the estimator is created.
+        """
+        with self.assertRaises(ValueError):
+            BlindRT60(**kwargs)
+
+    def test_estimate_batch(self, fs: int = 8000):
+        """
+        Test that the parallel estimation of several signals matches their sequential estimation.
+
+        Args:
+            fs (int): Signal and estimator sampling frequency.
+        """
+        xs = [decaying_chirp(fs, decay_rate=decay_rate) for decay_rate in (2, 5, 10)]
+        blind_rt60 = BlindRT60(fs=fs)
+        rt60s = blind_rt60.estimate_batch(xs, fs, n_workers=2)
+        np.testing.assert_allclose(rt60s, [blind_rt60(x, fs) for x in xs])
+
+    def test_estimate_multichannel(self, fs: int = 8000):
+        """
+        Test that the joint estimation of several channels matches the estimation of each channel.
+
+        Args:
+            fs (int): Signal and estimator sampling frequency.
+        """
+        x = np.stack([decaying_chirp(fs, decay_rate=decay_rate) for decay_rate in (2, 5, 10)])
+        blind_rt60 = BlindRT60(fs=fs)
+        rt60s = blind_rt60.estimate_multichannel(x, fs)
+        # The channels share the iteration loop, so frames may take a few more Newton steps than on their own
+        np.testing.assert_allclose(rt60s, [blind_rt60(channel, fs) for channel in x], rtol=1e-4)
+
+    @parameterized.expand([
+        param(fs_sig=8000, fs_estimator=8000),
+        param(fs_sig=16000, fs_estimator=8000),
+    ])
+    def test_estimate_stream(self, fs_sig: int, fs_estimator: int, n_chunks: int = 7):
+        """
+        Test that the estimation of a signal streamed in chunks does not depend on the chunk boundaries, and matches
+        the estimation of the whole signal when no decimation is needed.
+
+        Args:
+            fs_sig (int): Signal sampling frequency.
+            fs_estimator (int): Estimator sampling frequency.
+            n_chunks (int): Number of chunks of the stream.
+        """
+        x = decaying_chirp(fs_sig, decay_rate=5)
+        blind_rt60 = BlindRT60(fs=fs_estimator)
+
+        chunks = np.array_split(x, n_chunks)
+        for chunk in chunks[:-1]:
+            self.assertIsNone(blind_rt60.estimate_stream(chunk, fs_sig))
+        rt60 = blind_rt60.estimate_stream(chunks[-1], fs_sig, final=True)
+
+        self.assertAlmostEqual(rt60, blind_rt60.estimate_stream(x, fs_sig, final=True))
+        if fs_sig == fs_estimator:
+            self.assertAlmostEqual(rt60, blind_rt60(x, fs_sig), places=4)
+
+    @unittest.skipUnless(NUMBA_AVAILABLE, 'numba is not installed')
+    def test_kernel(self, fs: int = 8000):
+        """
+        Test that the compiled likelihood kernel matches the NumPy implementation.
+
+        Args:
+            fs (int): Signal and estimator sampling frequency.
+        """
+        x = decaying_chirp(fs)
+        blind_rt60 = BlindRT60(fs=fs)
+        x_frames = np.array([x[i:i + blind_rt60.framelen] for i in range(0, 16 * blind_rt60.hop, blind_rt60.hop)])
+        blind_rt60.init_states(x_frames.shape[0])
+        x2 = x_frames ** 2
+        a = np.linspace(blind_rt60.a_range[0], 0.9999, x_frames.shape[0])[:, None]
+
+        compiled = blind_rt60.likelihood_derivative(a, x2)
+        with mock.patch('blind_rt60.estimation.likelihood_kernel', None):
+            reference = blind_rt60.likelihood_derivative(a, x2)
+
+        for c, r in zip(compiled, reference):
+            np.testing.assert_allclose(c, r, rtol=1e-6)
+
+    @parameterized.expand([
+        param(fs_sig=8000, fs_estimator=8000),
+        param(fs_sig=16000, fs_estimator=8000),
+    ])
+    def test_numpy_fallback(self, fs_sig: int, fs_estimator: int):
+        """
+        Test the estimation end-to-end with the NumPy implementation used when numba is not installed.
+
+        Args:
+            fs_sig (int): Signal sampling frequency.
+            fs_estimator (int): Estimator sampling frequency.
+        """
+        x = decaying_chirp(fs_sig, decay_rate=5)
+        blind_rt60 = BlindRT60(fs=fs_estimator)
+        rt60 = blind_rt60(x, fs_sig)
+        with mock.patch('blind_rt60.estimation.likelihood_kernel', None):
+            rt60_numpy = blind_rt60(x, fs_sig)
+
+        self.assertTrue(np.all(np.isfinite(blind_rt60.taus[blind_rt60.converged])))
+        self.assertAlmostEqual(rt60_numpy, rt60, places=4)
+
     @parameterized.expand([
         param(rt60_tgt=0.3, max_err=0.25),
         param(rt60_tgt=0.8, max_err=0.25),